@@ -4,7 +4,7 @@ author: Continuum Labs
 version: 1.2.0
 license: MIT
 description: AI-powered care plan assistant that integrates with n8n workflow automation for aged care facilities. Guides users through 6 sections to create comprehensive, person-centred care plans.
-requirements: requests
+requirements: requests, orjson
 environment_variables: N8N_WEBHOOK_URL, N8N_AUTH_TOKEN
 """
 
@@ -17,6 +17,18 @@ import hashlib
 import time
 from pydantic import BaseModel, Field
 
+try:
+    import orjson  # Optional: faster encoding of the message history
+except ImportError:
+    orjson = None
+
+
+def _json_dumps(data) -> bytes:
+    """Serialize data to compact JSON bytes, using orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, allow_nan=False).encode("utf-8")
+
 
 class Pipeline:
     """
@@ -129,14 +141,15 @@ class Pipeline:
                 print(f"🆔 Session ID: {payload['chat']['id']}")
                 print(f"🔄 Sending to: {self.valves.n8n_webhook_url}")
             
-            # Send request to n8n
+            # Send request to n8n; the full message history is encoded with
+            # orjson when available instead of requests' stdlib json
             response = requests.post(
                 self.valves.n8n_webhook_url,
                 headers={
                     "Authorization": self.valves.n8n_auth_token,
                     "Content-Type": "application/json"
                 },
-                json=payload,
+                data=_json_dumps(payload),
                 timeout=self.valves.request_timeout
             )
             
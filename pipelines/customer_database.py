@@ -5,13 +5,60 @@ date: 2025-03-01
 version: 1.0
 license: MIT
 description: Retrieves customer information based on claim form data for verification
-requirements: pydantic
+requirements: pydantic, orjson, rapidfuzz
 """
 
 from pydantic import BaseModel
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, NamedTuple, Optional
 import json
 import os
+import threading
+# Required, not optional: match scores must not depend on what is installed
+from rapidfuzz import fuzz
+from rapidfuzz.distance import Levenshtein
+
+try:
+    import orjson  # Optional: faster parsing of the customer data file
+except ImportError:
+    orjson = None
+
+
+def _json_loads(raw: bytes):
+    """Parse JSON bytes, using orjson when it is installed"""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def _json_dumps(data) -> bytes:
+    """Serialize data to indented JSON bytes, using orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    return json.dumps(data, indent=2).encode("utf-8")
+
+
+def _similarity(a: str, b: str, cutoff: float) -> float:
+    """Fuzzy similarity of two strings in the 0-1 range; 0 when below cutoff (0-100 scale)"""
+    # Whole-string ratio on sorted tokens: reordered names still match, but
+    # a fragment such as a first name alone is not scored as a near match
+    return fuzz.token_sort_ratio(a, b, score_cutoff=cutoff) / 100.0
+
+
+def _edit_distance(a: str, b: str, max_distance: int) -> int:
+    """Levenshtein distance of a and b, or max_distance + 1 once it is exceeded"""
+    return Levenshtein.distance(a, b, score_cutoff=max_distance)
+
+
+class _CustomerSnapshot(NamedTuple):
+    """One loaded version of the customer data, replaced as a whole on reload"""
+    customer_data: Any
+    customer_records: List[tuple]
+    field_index: Dict[str, Dict[str, List[int]]]
+    records_by_id: Dict[int, tuple]
+
+
+_EMPTY_SNAPSHOT = _CustomerSnapshot(None, [], {}, {})
+
 
 class Pipeline:
     class Valves(BaseModel):
@@ -19,33 +66,57 @@ class Pipeline:
         MATCH_THRESHOLD: float = 0.7  # Confidence threshold for matches
         HIGHLIGHT_DISCREPANCIES: bool = True
     
+    # Field weights for scoring (importance of each field)
+    _WEIGHTS = (
+        ("policy_number", 10),
+        ("full_name", 8),
+        ("email_address", 7),
+        ("phone_number", 6),
+        ("vehicle_vin", 10),
+        ("license_plate", 9),
+        ("vehicle_make", 3),
+        ("vehicle_model", 3),
+        ("vehicle_year", 2),
+    )
+    # Heaviest fields first, so scoring can stop early on hopeless candidates
+    _WEIGHTS_DESC = tuple(sorted(_WEIGHTS, key=lambda item: -item[1]))
+    
+    # Selective fields hashed at load time to find candidate customers
+    _INDEXED_FIELDS = ("policy_number", "vehicle_vin", "license_plate", "email_address", "phone_number", "full_name")
+    
+    # Files up to this size are scanned in full when no indexed value matches
+    _FULL_SCAN_LIMIT = 1000
+    
+    # Free-text fields that earn partial credit for near matches
+    _FUZZY_FIELDS = frozenset(("full_name", "vehicle_make", "vehicle_model"))
+    _FUZZY_CUTOFF = 70
+    
+    # Identifier fields where a small typo still earns partial credit; one
+    # typo is allowed per _TYPO_SPAN characters, at most _MAX_TYPOS, so short
+    # plates and policy numbers tolerate one edit and full VINs two
+    _TYPO_FIELDS = frozenset(("policy_number", "vehicle_vin", "license_plate"))
+    _TYPO_SPAN = 8
+    _MAX_TYPOS = 2
+    
     def __init__(self):
         self.name = "Customer Retrieval Pipeline"
         self.valves = self.Valves()
-        self.customer_data = None
+        self._snapshot = _EMPTY_SNAPSHOT
+        self._data_lock = threading.Lock()
+        self._loaded = False
+        self._mtime = None
     
     async def on_startup(self):
-        """Load the demo customer data when the pipeline starts"""
-        try:
-            if os.path.exists(self.valves.CUSTOMER_DATA_PATH):
-                with open(self.valves.CUSTOMER_DATA_PATH, 'r') as f:
-                    self.customer_data = json.load(f)
-            else:
-                # Create a demo customer if file doesn't exist
-                self.customer_data = self._create_demo_customer()
-                
-                # Save the demo customer for future use
-                os.makedirs(os.path.dirname(self.valves.CUSTOMER_DATA_PATH), exist_ok=True)
-                with open(self.valves.CUSTOMER_DATA_PATH, 'w') as f:
-                    json.dump(self.customer_data, f, indent=2)
-            
-            print(f"Customer Retrieval Pipeline started with demo customer: {self.customer_data['customer_information']['full_name']}")
-        except Exception as e:
-            print(f"Error loading customer data: {str(e)}")
+        """Resolve the customer data source; the data itself is loaded on first use"""
+        if os.path.exists(self.valves.CUSTOMER_DATA_PATH):
+            print(f"Customer Retrieval Pipeline started with customer data: {self.valves.CUSTOMER_DATA_PATH}")
+        else:
+            print("Customer Retrieval Pipeline started; a demo customer will be created on first use")
     
     async def on_shutdown(self):
         """Clean up resources when the pipeline shuts down"""
-        self.customer_data = None
+        self._snapshot = _EMPTY_SNAPSHOT
+        self._loaded = False
         print("Customer Retrieval Pipeline shut down.")
     
     def pipe(self, claim_data, model_id=None, messages=None, body=None):
@@ -58,8 +129,13 @@ class Pipeline:
         Returns:
             Dictionary with customer data and match information
         """
+        self._ensure_loaded()
+        
+        # Read once: a reload during this call must not mix two versions
+        snapshot = self._snapshot
+        
         try:
-            if not self.customer_data:
+            if not snapshot.customer_data:
                 return {
                     "status": "error",
                     "message": "Customer database not initialized"
@@ -69,10 +145,10 @@ class Pipeline:
             search_params = self._extract_search_params(claim_data)
             
             # Calculate match score
-            match_results = self._calculate_match(search_params)
+            match_results = self._calculate_match(search_params, snapshot)
             
             # Check if match exceeds threshold
-            if match_results["match_score"] < self.valves.MATCH_THRESHOLD:
+            if not self._is_match(match_results):
                 return {
                     "status": "no_match",
                     "message": "No customer record matched the claim information",
@@ -80,8 +156,9 @@ class Pipeline:
                     "match_score": match_results["match_score"]
                 }
             
-            # Prepare the response
-            customer_profile = self.customer_data.copy()
+            # Prepare the response; the profile is the loaded record itself,
+            # shared across calls, so callers must treat it as read-only
+            customer_profile = match_results["customer"]
             
             # Add match information
             result = {
@@ -101,6 +178,93 @@ class Pipeline:
                 "message": f"Error retrieving customer data: {str(e)}"
             }
     
+    @property
+    def customer_data(self):
+        """The loaded customer data, None until the first load"""
+        return self._snapshot.customer_data
+    
+    def _ensure_loaded(self):
+        """Load the customer data on first use, and reload it when the file changes"""
+        if self._is_current():
+            return
+        
+        with self._data_lock:
+            if self._is_current():
+                return
+            
+            try:
+                self._load_customer_data()
+                self._loaded = True
+            except Exception as e:
+                print(f"Error loading customer data: {str(e)}")
+    
+    def _is_current(self):
+        """True when data is loaded and the file hasn't changed since (one stat call)"""
+        if not self._loaded:
+            return False
+        try:
+            mtime = os.stat(self.valves.CUSTOMER_DATA_PATH).st_mtime_ns
+        except OSError:
+            # File removed after loading: keep serving what we have
+            return True
+        return mtime == self._mtime
+    
+    def _load_customer_data(self):
+        """Read the customer file (creating the demo customer if missing) and index it"""
+        mtime = None
+        try:
+            if os.path.exists(self.valves.CUSTOMER_DATA_PATH):
+                # Stat before reading so a write racing the read triggers another reload
+                mtime = os.stat(self.valves.CUSTOMER_DATA_PATH).st_mtime_ns
+                with open(self.valves.CUSTOMER_DATA_PATH, 'rb') as f:
+                    raw = f.read()
+                customer_data = _json_loads(raw)
+            else:
+                # Create a demo customer if file doesn't exist
+                customer_data = self._create_demo_customer()
+                
+                # Save the demo customer for future use
+                os.makedirs(os.path.dirname(self.valves.CUSTOMER_DATA_PATH), exist_ok=True)
+                raw = _json_dumps(customer_data)
+                with open(self.valves.CUSTOMER_DATA_PATH, 'wb') as f:
+                    f.write(raw)
+                mtime = os.stat(self.valves.CUSTOMER_DATA_PATH).st_mtime_ns
+            
+            # Index into locals first: a file that parses but holds a bad record
+            # raises here and leaves the previously loaded data fully in place
+            customer_records, field_index = self._build_customer_index(customer_data, raw)
+        except Exception:
+            if mtime is not None and self._loaded:
+                # Keep serving the previous data, and don't retry this broken
+                # version of the file on every call; the next write reloads it
+                self._mtime = mtime
+            raise
+        
+        # Identity lookup for get_customer_profile_bytes; the records stay
+        # alive while loaded, so their ids can't be reused meanwhile
+        records_by_id = {id(entry[0]): entry for entry in customer_records}
+        
+        # Publish with a single assignment: a concurrent pipe() call works on
+        # either the old snapshot or the new one, never a mix of the two
+        self._snapshot = _CustomerSnapshot(customer_data, customer_records, field_index, records_by_id)
+        self._mtime = mtime
+        
+        print(f"Customer Retrieval Pipeline loaded {len(customer_records)} customer record(s)")
+    
+    def get_customer_profile_bytes(self, customer_profile):
+        """
+        JSON bytes for a customer_profile returned by pipe().
+        
+        Lets an HTTP layer send the profile without re-serializing it. Each
+        loaded record carries its bytes from load time (a single-record data
+        file is served as read). Objects that aren't a loaded record are
+        serialized on every call and never cached.
+        """
+        entry = self._snapshot.records_by_id.get(id(customer_profile))
+        if entry is not None and entry[0] is customer_profile:
+            return entry[3]
+        return _json_dumps(customer_profile)
+    
     def _extract_search_params(self, claim_data):
         """Extract search parameters from claim data"""
         search_params = {}
@@ -133,44 +297,53 @@ class Pipeline:
         
         return search_params
     
-    def _calculate_match(self, search_params):
+    def _build_customer_index(self, customer_data, raw):
         """
-        Calculate match score and identify discrepancies.
+        Flatten each customer record into its comparable fields and hash the
+        selective ones.
         
-        For demo purposes, this will do a simple field comparison with the demo customer.
+        The data file may hold a single customer record or a list of them.
+        Returns (customer_records, field_index). Each customer record entry is
+        (record, customer_info, customer_lower, profile_bytes); field_index
+        maps field -> normalized value -> record positions, so a claim only
+        has to be scored against customers sharing an exact value.
         """
-        matched_fields = []
-        discrepancies = []
-        total_weight = 0
-        matched_weight = 0
+        records = customer_data if isinstance(customer_data, list) else [customer_data]
         
-        # Field weights for scoring (importance of each field)
-        weights = {
-            "policy_number": 10,
-            "full_name": 8,
-            "email_address": 7,
-            "phone_number": 6,
-            "vehicle_vin": 10,
-            "license_plate": 9,
-            "vehicle_make": 3,
-            "vehicle_model": 3,
-            "vehicle_year": 2
-        }
+        customer_records = []
+        field_index = {field: {} for field in self._INDEXED_FIELDS}
+        
+        for position, record in enumerate(records):
+            customer_info = self._extract_customer_info(record)
+            customer_lower = {
+                field: str(value).lower().strip() for field, value in customer_info.items()
+            }
+            # A single-record file already is the serialized profile
+            profile_bytes = raw if record is customer_data else _json_dumps(record)
+            customer_records.append((record, customer_info, customer_lower, profile_bytes))
+            
+            for field in self._INDEXED_FIELDS:
+                value = customer_lower.get(field)
+                if value:
+                    field_index[field].setdefault(value, []).append(position)
         
-        # Extract customer info for comparison
+        return customer_records, field_index
+    
+    def _extract_customer_info(self, record):
+        """Pull the fields compared against claims out of one customer record"""
         customer_info = {
-            "full_name": self.customer_data["customer_information"]["full_name"],
-            "email_address": self.customer_data["customer_information"]["contact_information"]["email"],
-            "phone_number": self.customer_data["customer_information"]["contact_information"]["phone"]
+            "full_name": record["customer_information"]["full_name"],
+            "email_address": record["customer_information"]["contact_information"]["email"],
+            "phone_number": record["customer_information"]["contact_information"]["phone"]
         }
         
         # Add policy information
-        if self.customer_data["policy_summary"]["policies"]:
-            customer_info["policy_number"] = self.customer_data["policy_summary"]["policies"][0]["policy_id"]
+        if record["policy_summary"]["policies"]:
+            customer_info["policy_number"] = record["policy_summary"]["policies"][0]["policy_id"]
         
         # Add vehicle information if available
-        if self.customer_data["vehicle_summary"]["vehicles"]:
-            vehicle = self.customer_data["vehicle_summary"]["vehicles"][0]
+        if record["vehicle_summary"]["vehicles"]:
+            vehicle = record["vehicle_summary"]["vehicles"][0]
             make_model = vehicle["make_model"].split()
             customer_info["vehicle_make"] = make_model[0] if make_model else ""
             customer_info["vehicle_model"] = make_model[1] if len(make_model) > 1 else ""
@@ -178,24 +351,171 @@ class Pipeline:
             customer_info["vehicle_vin"] = vehicle["vin"]
             customer_info["license_plate"] = vehicle["license_plate"]
         
-        # Compare fields and calculate score
-        for field, weight in weights.items():
+        return customer_info
+    
+    def _find_candidates(self, search_params, snapshot):
+        """
+        Probe the field index with the claim's selective fields.
+        
+        Returns the positions of customers sharing at least one exact indexed
+        value with the claim. Claims carrying none of the indexed fields are
+        compared against every customer. When no customer shares an exact
+        value (every identifier may carry a typo) small files are scanned in
+        full and larger ones are blocked on name similarity instead.
+        """
+        probed = False
+        candidates = set()
+        
+        for field in self._INDEXED_FIELDS:
+            if field in search_params:
+                probed = True
+                value = str(search_params[field]).lower().strip()
+                candidates.update(snapshot.field_index[field].get(value, ()))
+        
+        if not probed:
+            return range(len(snapshot.customer_records))
+        
+        if candidates:
+            return sorted(candidates)
+        
+        if len(snapshot.customer_records) <= self._FULL_SCAN_LIMIT:
+            return range(len(snapshot.customer_records))
+        
+        if "full_name" not in search_params:
+            return []
+        
+        name = str(search_params["full_name"]).lower().strip()
+        return [
+            position
+            for position, (_, _, customer_lower, _) in enumerate(snapshot.customer_records)
+            if _similarity(name, customer_lower.get("full_name", ""), self._FUZZY_CUTOFF)
+        ]
+    
+    def _calculate_match(self, search_params, snapshot):
+        """
+        Calculate match score and identify discrepancies.
+        
+        Only the candidates from _find_candidates are scored; the best one
+        (see _outranks) is returned under "customer" (None when there are no
+        candidates).
+        
+        Candidates are first scored with early exit. A candidate that exits
+        early is certain to fall below MATCH_THRESHOLD, so it can never beat
+        one that reaches it. If no candidate is a match, the ones
+        that exited early are rescored in full so the reported no_match score
+        and the choice of best candidate use exact scores, not lower bounds.
+        """
+        best = {
+            "match_score": 0,
+            "matched_fields": [],
+            "discrepancies": [],
+            "customer": None
+        }
+        exited_early = []
+        
+        for position in self._find_candidates(search_params, snapshot):
+            record, customer_info, customer_lower, _ = snapshot.customer_records[position]
+            results = self._score_customer(search_params, customer_info, customer_lower)
+            
+            if results["early_exit"]:
+                exited_early.append(position)
+                continue
+            
+            if best["customer"] is None or self._outranks(results, best):
+                results["customer"] = record
+                best = results
+        
+        if self._is_match(best):
+            return best
+        
+        for position in exited_early:
+            record, customer_info, customer_lower, _ = snapshot.customer_records[position]
+            results = self._score_customer(search_params, customer_info, customer_lower, early_exit=False)
+            
+            if best["customer"] is None or self._outranks(results, best):
+                results["customer"] = record
+                best = results
+        
+        return best
+    
+    def _is_match(self, results):
+        """
+        Whether a scored candidate counts as a match: it must reach
+        MATCH_THRESHOLD and agree exactly on at least one field, so partial
+        credit for near matches alone never identifies a customer.
+        """
+        return bool(results["matched_fields"]) and results["match_score"] >= self.valves.MATCH_THRESHOLD
+    
+    def _outranks(self, results, best):
+        """Whether results beats best: matches first, then the higher score"""
+        return (self._is_match(results), results["match_score"]) > (self._is_match(best), best["match_score"])
+    
+    def _score_customer(self, search_params, customer_info, customer_lower, early_exit=True):
+        """
+        Weighted field comparison of the claim against one customer.
+        
+        Fields are compared heaviest first; with early_exit, once even full
+        credit on the remaining fields could not reach MATCH_THRESHOLD the
+        comparison stops and the result is flagged with early_exit (its score
+        is then a lower bound, and discrepancies only cover the fields
+        compared so far).
+        """
+        matched_fields = []
+        discrepancies = []
+        matched_weight = 0
+        exited = False
+        
+        # Weight of the fields both sides carry, i.e. the score denominator
+        total_weight = 0
+        for field, weight in self._WEIGHTS_DESC:
             if field in search_params and field in customer_info:
                 total_weight += weight
-                
-                # Case-insensitive comparison for text fields
-                claim_value = str(search_params[field]).lower().strip()
-                db_value = str(customer_info[field]).lower().strip()
-                
-                if claim_value == db_value:
-                    matched_fields.append(field)
-                    matched_weight += weight
-                else:
-                    discrepancies.append({
-                        "field": field,
-                        "claim_value": search_params[field],
-                        "database_value": customer_info[field]
-                    })
+        
+        required_weight = self.valves.MATCH_THRESHOLD * total_weight
+        remaining_weight = total_weight
+        
+        # Compare fields and calculate score
+        for field, weight in self._WEIGHTS_DESC:
+            if field not in search_params or field not in customer_info:
+                continue
+            
+            remaining_weight -= weight
+            
+            # Case-insensitive comparison for text fields
+            claim_value = str(search_params[field]).lower().strip()
+            db_value = customer_lower[field]
+            
+            if claim_value == db_value:
+                matched_fields.append(field)
+                matched_weight += weight
+                continue
+            
+            discrepancy = {
+                "field": field,
+                "claim_value": search_params[field],
+                "database_value": customer_info[field]
+            }
+            
+            # Near matches on free-text fields still earn partial weight
+            if field in self._FUZZY_FIELDS:
+                similarity = _similarity(claim_value, db_value, self._FUZZY_CUTOFF)
+                if similarity:
+                    matched_weight += weight * similarity
+                    discrepancy["similarity"] = round(similarity, 2)
+            elif field in self._TYPO_FIELDS:
+                max_typos = min(self._MAX_TYPOS, min(len(claim_value), len(db_value)) // self._TYPO_SPAN)
+                distance = _edit_distance(claim_value, db_value, max_typos)
+                if 0 < distance <= max_typos:
+                    similarity = 1 - distance / max(len(claim_value), len(db_value))
+                    matched_weight += weight * similarity
+                    discrepancy["similarity"] = round(similarity, 2)
+            
+            discrepancies.append(discrepancy)
+            
+            # The threshold is out of reach even if every remaining field matches
+            if early_exit and matched_weight + remaining_weight < required_weight:
+                exited = True
+                break
         
         # Calculate final score (0-1 range)
         match_score = matched_weight / total_weight if total_weight > 0 else 0
@@ -203,7 +523,8 @@ class Pipeline:
         return {
             "match_score": match_score,
             "matched_fields": matched_fields,
-            "discrepancies": discrepancies
+            "discrepancies": discrepancies,
+            "early_exit": exited
         }
     
     def _create_verification_summary(self, match_results):
@@ -221,17 +542,16 @@ class Pipeline:
         else:
             confidence = "Low confidence match"
         
-        summary = f"{confidence} ({score:.2f}). {matched} fields matched with {discrepancies} discrepancies."
+        parts = [f"{confidence} ({score:.2f}). {matched} fields matched with {discrepancies} discrepancies."]
         
         if discrepancies > 0:
-            summary += " Please review the discrepancies carefully."
+            parts.append(" Please review the discrepancies carefully.")
             
             # Add specific discrepancy details
-            summary += " Discrepancies found in: "
-            discrepancy_fields = [d["field"] for d in match_results["discrepancies"]]
-            summary += ", ".join(discrepancy_fields)
+            parts.append(" Discrepancies found in: ")
+            parts.append(", ".join(d["field"] for d in match_results["discrepancies"]))
         
-        return summary
+        return "".join(parts)
     
     def _create_demo_customer(self):
         """Create a demo customer for testing"""
@@ -8,14 +8,19 @@ description: A sophisticated math expression solver that provides detailed step-
 requirements: pydantic
 """
 
-from typing import List, Union, Generator, Iterator, Dict, Any
+from typing import List, Union, Generator, Iterator, Dict, Any, Tuple
 from pydantic import BaseModel
 import ast
 import operator
 import logging
-from decimal import Decimal, InvalidOperation
+import math
+from decimal import Decimal
+from functools import lru_cache
 import re
 
+_WS_RE = re.compile(r'\s+')
+_VALID_EXPR_RE = re.compile(r'[0-9+\-*/.()\[\]{}]*')
+
 class Pipeline:
     class Valves(BaseModel):
         """Configuration parameters for the math solver pipeline"""
@@ -26,6 +31,8 @@ class Pipeline:
         
     class MathNode:
         """Helper class for tracking mathematical operations"""
+        __slots__ = ('expression', 'value', 'operation')
+        
         def __init__(self, expression: str, value: float, operation: str = None):
             self.expression = expression
             self.value = value
@@ -34,12 +41,18 @@ class Pipeline:
     def __init__(self):
         self.name = "Advanced Math Problem Solver"
         self.valves = self.Valves()
+        # Operator type -> (function, display symbol, operand validator or None)
         self.operators = {
-            ast.Add: (operator.add, '+'),
-            ast.Sub: (operator.sub, '-'),
-            ast.Mult: (operator.mul, '×'),
-            ast.Div: (operator.truediv, '÷'),
-            ast.Pow: (operator.pow, '^'),
+            ast.Add: (operator.add, '+', None),
+            ast.Sub: (operator.sub, '-', None),
+            ast.Mult: (operator.mul, '×', None),
+            ast.Div: (operator.truediv, '÷', self._check_divisor),
+            ast.Pow: (operator.pow, '^', self._check_exponent),
+        }
+        # Node type -> evaluator, so evaluate_node does one lookup per node
+        self._node_dispatch = {
+            ast.Constant: self._eval_const,
+            ast.BinOp: self._eval_binop,
         }
         
     async def on_startup(self):
@@ -52,72 +65,141 @@ class Pipeline:
 
     def sanitize_expression(self, expression: str) -> str:
         """Clean and validate the mathematical expression"""
+        return self._sanitize_cached(expression, self.valves.MAX_EXPRESSION_LENGTH)
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def _sanitize_cached(expression: str, max_length: int) -> str:
+        """Pure sanitizer behind sanitize_expression, memoized per (expression, limit)"""
         # Remove whitespace and convert operators
-        expression = re.sub(r'\s+', '', expression)
+        expression = _WS_RE.sub('', expression)
         expression = expression.replace('^', '**')
         
         # Basic validation
-        if len(expression) > self.valves.MAX_EXPRESSION_LENGTH:
-            raise ValueError(f"Expression too long (max {self.valves.MAX_EXPRESSION_LENGTH} characters)")
+        if len(expression) > max_length:
+            raise ValueError(f"Expression too long (max {max_length} characters)")
         
         # Check for invalid characters
-        valid_chars = set('0123456789+-*/.()[]{}') 
-        if not all(c in valid_chars for c in expression.replace('**', '')):
+        if not _VALID_EXPR_RE.fullmatch(expression):
             raise ValueError("Expression contains invalid characters")
             
         return expression
 
     def format_number(self, number: float) -> str:
         """Format number to specified decimal places and remove trailing zeros"""
-        try:
-            decimal = Decimal(str(number))
-            formatted = f"{decimal:.{self.valves.DECIMAL_PLACES}f}"
-            # Remove trailing zeros after decimal point
-            if '.' in formatted:
-                formatted = formatted.rstrip('0').rstrip('.')
-            return formatted
-        except InvalidOperation:
+        if not isinstance(number, float):
+            # ints need no rounding; complex results (fractional powers of
+            # negatives) can't be rounded, so show them as-is
             return str(number)
+        places = self.valves.DECIMAL_PLACES
+        if math.isfinite(number) and abs(number) < 10.0 ** (15 - places):
+            formatted = f"{number:.{places}f}"
+        else:
+            # Beyond float precision (or non-finite): format the shortest repr
+            # so binary expansion digits don't leak into the output
+            formatted = f"{Decimal(repr(number)):.{places}f}"
+        # Remove trailing zeros after decimal point
+        if '.' in formatted:
+            formatted = formatted.rstrip('0').rstrip('.')
+        return formatted
 
-    def evaluate_node(self, node: ast.AST, steps: List[str]) -> MathNode:
+    def evaluate_node(self, node: ast.AST, steps: List[Tuple[str, float]]) -> MathNode:
         """Recursively evaluate AST nodes while tracking steps"""
-        if isinstance(node, ast.Num):
-            return self.MathNode(str(node.n), node.n)
+        handler = self._node_dispatch.get(type(node))
+        if handler is None:
+            raise ValueError("Unsupported operation in expression")
+        return handler(node, steps)
+
+    def _eval_const(self, node: ast.Constant, steps: List[Tuple[str, float]]) -> MathNode:
+        """Evaluate a numeric literal"""
+        value = node.value
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError("Unsupported operation in expression")
+        return self.MathNode(str(value), value)
+
+    def _eval_binop(self, node: ast.BinOp, steps: List[Tuple[str, float]]) -> MathNode:
+        """Evaluate a binary operation and record it as a solution step"""
+        # Get operator information
+        op_func, op_symbol, validate = self.operators[type(node.op)]
+        
+        # Evaluate left and right nodes
+        left = self.evaluate_node(node.left, steps)
+        right = self.evaluate_node(node.right, steps)
+        
+        # Perform operation
+        try:
+            if validate is not None:
+                validate(left.value, right.value)
+                
+            result = op_func(left.value, right.value)
             
-        elif isinstance(node, ast.BinOp):
-            # Get operator information
-            op_func, op_symbol = self.operators[type(node.op)]
+            # Format the expression
+            expr = f"({left.expression} {op_symbol} {right.expression})"
             
-            # Evaluate left and right nodes
-            left = self.evaluate_node(node.left, steps)
-            right = self.evaluate_node(node.right, steps)
+            # Add step to solution (formatted later in solve_expression)
+            if self.valves.SHOW_STEPS:
+                steps.append((expr, result))
             
-            # Perform operation
-            try:
-                if isinstance(node.op, ast.Div) and right.value == 0:
-                    raise ValueError("Division by zero")
-                    
-                if isinstance(node.op, ast.Pow):
-                    if right.value > self.valves.MAX_POWER:
-                        raise ValueError(f"Power exceeds maximum allowed ({self.valves.MAX_POWER})")
-                    
-                result = op_func(left.value, right.value)
-                
-                # Format the expression
-                expr = f"({left.expression} {op_symbol} {right.expression})"
-                
-                # Add step to solution
-                if self.valves.SHOW_STEPS:
-                    formatted_result = self.format_number(result)
-                    steps.append(f"{expr} = {formatted_result}")
-                
-                return self.MathNode(expr, result, op_symbol)
-                
-            except (OverflowError, ValueError) as e:
-                raise ValueError(f"Calculation error: {str(e)}")
-                
-        else:
-            raise ValueError("Unsupported operation in expression")
+            return self.MathNode(expr, result, op_symbol)
+            
+        except (OverflowError, ValueError) as e:
+            raise ValueError(f"Calculation error: {str(e)}")
+
+    def _check_divisor(self, left: float, right: float):
+        """Reject division by zero"""
+        if right == 0:
+            raise ValueError("Division by zero")
+
+    def _check_exponent(self, left: float, right: float):
+        """Reject exponents above MAX_POWER"""
+        if right > self.valves.MAX_POWER:
+            raise ValueError(f"Power exceeds maximum allowed ({self.valves.MAX_POWER})")
+
+    @staticmethod
+    @lru_cache(maxsize=512)
+    def _parse_cached(clean_expr: str) -> ast.Expression:
+        """Parse a sanitized expression, memoized for repeated inputs"""
+        return ast.parse(clean_expr, mode='eval')
+
+    @staticmethod
+    @lru_cache(maxsize=512)
+    def _compile_cached(clean_expr: str):
+        """Compile a sanitized expression for eval(), memoized for repeated inputs"""
+        return compile(Pipeline._parse_cached(clean_expr), '<expr>', 'eval')
+
+    def _can_fast_eval(self, tree: ast.Expression) -> bool:
+        """
+        Check whether a parsed expression can be handed to eval() directly.
+        
+        Only numeric constants and the supported binary operators are allowed,
+        and every power must have a constant exponent within MAX_POWER so the
+        limit is enforced before evaluation. Anything else goes through
+        evaluate_node, which reports the usual errors.
+        """
+        for node in ast.walk(tree.body):
+            node_type = type(node)
+            if node_type is ast.BinOp:
+                if type(node.op) not in self.operators:
+                    return False
+                if type(node.op) is ast.Pow:
+                    exponent = node.right
+                    if type(exponent) is not ast.Constant or exponent.value > self.valves.MAX_POWER:
+                        return False
+            elif node_type is ast.Constant:
+                if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+                    return False
+            elif node_type not in self.operators:
+                return False
+        return True
+
+    def _fast_eval(self, clean_expr: str) -> float:
+        """Evaluate an expression accepted by _can_fast_eval without tracking steps"""
+        try:
+            return eval(self._compile_cached(clean_expr), {'__builtins__': {}}, {})
+        except ZeroDivisionError:
+            raise ValueError("Calculation error: Division by zero")
+        except OverflowError as e:
+            raise ValueError(f"Calculation error: {str(e)}")
 
     def solve_expression(self, expression: str) -> Dict[str, Any]:
         """Solve the mathematical expression and provide detailed solution"""
@@ -125,23 +207,28 @@ class Pipeline:
             # Sanitize and prepare expression
             clean_expr = self.sanitize_expression(expression)
             
-            # Parse expression
-            tree = ast.parse(clean_expr, mode='eval')
+            # Parse expression (cached; the tree is only ever read)
+            tree = self._parse_cached(clean_expr)
             
             # Track solution steps
             steps = []
             
-            # Evaluate expression
-            result = self.evaluate_node(tree.body, steps)
+            # Evaluate expression; without steps, let CPython evaluate the
+            # validated tree directly instead of walking it in Python
+            if not self.valves.SHOW_STEPS and self._can_fast_eval(tree):
+                value = self._fast_eval(clean_expr)
+            else:
+                value = self.evaluate_node(tree.body, steps).value
             
             # Format output
-            formatted_result = self.format_number(result.value)
+            formatted_result = self.format_number(value)
             
             return {
                 'success': True,
                 'original': expression,
                 'result': formatted_result,
-                'steps': steps if self.valves.SHOW_STEPS else None
+                'steps': [f"{step_expr} = {self.format_number(step_value)}" for step_expr, step_value in steps]
+                         if self.valves.SHOW_STEPS else None
             }
             
         except (SyntaxError, ValueError) as e:
@@ -5,16 +5,211 @@ date: 2024-12-01
 version: 1.3
 license: MIT
 description: A pipeline for ResetData hosted Llama models with configurable token limits.
-requirements: requests
+requirements: requests, orjson
 environment_variables: RESETDATA_API_KEY
 """
 
 import os
-import requests
 import json
-from typing import List, Union, Generator, Iterator
+import logging
+import threading
+from functools import lru_cache
+from types import MappingProxyType
+from typing import List, Mapping, Union, Generator, Iterator
 from pydantic import BaseModel, Field
 
+try:
+    import orjson  # Optional: faster request encoding and SSE chunk parsing
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on error text carried into exception messages
+_MAX_ERROR_CHARS = 2048
+
+
+def _json_loads(raw: bytes):
+    """Parse JSON bytes, using orjson when it is installed"""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def _json_dumps(data) -> bytes:
+    """Serialize data to compact JSON bytes, using orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, allow_nan=False).encode("utf-8")
+
+
+def _extract_error(response) -> str:
+    """
+    Pull the error message out of a failed API response.
+    Falls back to the raw body, truncated so a large HTML error page from a
+    gateway isn't copied into the exception message.
+    """
+    try:
+        error = _json_loads(response.content).get("error")
+        if isinstance(error, dict) and error.get("message"):
+            return str(error["message"])[:_MAX_ERROR_CHARS]
+    except (ValueError, AttributeError):
+        # Not JSON, or not a JSON object
+        pass
+    return response.text[:_MAX_ERROR_CHARS]
+
+
+def _iter_lines(response, chunk_size: int = 65536) -> Iterator[bytes]:
+    """
+    Yield raw lines from a streamed response.
+    Partial lines stay in a single bytearray between socket reads rather
+    than being re-joined and re-scanned on every chunk.
+    """
+    buf = bytearray()
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        buf.extend(chunk)
+        while (nl := buf.find(b"\n")) != -1:
+            line = bytes(buf[:nl])
+            del buf[:nl + 1]
+            yield line.rstrip(b"\r")
+    if buf:
+        yield bytes(buf).rstrip(b"\r")
+
+
+def _iter_events(response) -> Iterator[bytes]:
+    """
+    Yield the data payload of each server-sent event.
+    Events end at a blank line; several events may arrive in one chunk, and
+    multiple data fields within an event are joined with newlines per the
+    SSE spec. Comments and other fields are ignored.
+    A data line that is complete on its own (a JSON object, or [DONE]) and
+    starts a new event is yielded straight away, so servers or proxies that
+    drop the blank separator lines still stream chunk by chunk.
+    """
+    data = []
+    for line in _iter_lines(response):
+        if not line:
+            if data:
+                yield b"\n".join(data)
+                data = []
+            continue
+        field, _, value = line.partition(b":")
+        if field == b"data":
+            value = value[1:] if value.startswith(b" ") else value
+            if not data and (value == b"[DONE]" or (value.startswith(b"{") and value.endswith(b"}"))):
+                yield value
+                continue
+            data.append(value)
+    if data:
+        yield b"\n".join(data)
+
+
+class _ResetDataHTTP:
+    """
+    HTTP layer shared by every ResetData pipeline instance in the process.
+    Holds one pooled keep-alive session so consecutive completions skip the
+    TCP+TLS handshake, and keeps retry and timeout settings in one place.
+    """
+
+    TIMEOUT = 600
+
+    def __init__(self):
+        # Imported here so loading the pipeline doesn't pull in requests/urllib3/ssl
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=32,
+            max_retries=Retry(total=2, backoff_factor=0.2)
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Content-Type": "application/json"})
+
+    def post(self, url: str, headers: dict, data: bytes, stream: bool = False):
+        # Non-streaming bodies use the session's default Accept-Encoding (gzip,
+        # deflate, plus br/zstd when their decoders are installed). Compressed
+        # SSE gets buffered by proxies until a block fills, delaying tokens,
+        # so streams ask for identity.
+        if stream:
+            headers = {**headers, "Accept-Encoding": "identity"}
+        return self.session.post(
+            url,
+            headers=headers,
+            data=data,
+            stream=stream,
+            timeout=self.TIMEOUT
+        )
+
+
+_HTTP = None
+_HTTP_LOCK = threading.Lock()
+
+
+def _get_http() -> _ResetDataHTTP:
+    """Return the shared HTTP layer, creating it on first use"""
+    global _HTTP
+    if _HTTP is None:
+        with _HTTP_LOCK:
+            if _HTTP is None:
+                _HTTP = _ResetDataHTTP()
+    return _HTTP
+
+# Request options forwarded from the Open WebUI body to the API
+_PAYLOAD_KEYS = (
+    "max_tokens",
+    "temperature",
+    "top_p",
+    "stream",
+    "stop",
+    "frequency_penalty",
+    "presence_penalty",
+)
+
+# Every supported model, keyed by the simplified ID exposed to Open WebUI:
+# (display name, ResetData model ID, max_tokens cap or None for uncapped,
+#  context_window, supports_vision)
+_MODEL_REGISTRY = MappingProxyType({
+    "llama-4-maverick": (
+        "Llama 4 Maverick 17B (1M context)",
+        "meta-llama/Llama-4-Maverick-17B-128E-Instruct:shared",
+        None, 1000000, True,
+    ),
+    "llama-3.2-vision": (
+        "Llama 3.2 11B Vision Instruct",
+        "meta/llama-3.2-11b-vision-instruct:shared",
+        8192, 128000, True,
+    ),
+    "llama-3.1-8b": (
+        "Llama 3.1 8B Instruct (Fast)",
+        "meta/llama-3.1-8b-instruct:shared",
+        8192, 128000, False,
+    ),
+})
+
+_DEFAULT_MODEL_CONFIG = MappingProxyType({
+    "max_tokens": 8192,
+    "context_window": 128000,
+    "supports_vision": False,
+})
+
+
+@lru_cache(maxsize=64)
+def _resolve_model_config(model_id: str, default_max_tokens: int) -> Mapping:
+    """Build the read-only config for a model, shared between calls with the same valve value"""
+    entry = _MODEL_REGISTRY.get(model_id)
+    if entry is None:
+        return _DEFAULT_MODEL_CONFIG
+    _, _, cap, context_window, supports_vision = entry
+    return MappingProxyType({
+        "max_tokens": default_max_tokens if cap is None else min(default_max_tokens, cap),
+        "context_window": context_window,
+        "supports_vision": supports_vision,
+    })
+
 
 class Pipeline:
     class Valves(BaseModel):
@@ -35,12 +230,7 @@ class Pipeline:
             DEFAULT_TEMPERATURE=float(os.getenv("RESETDATA_TEMPERATURE", "0.7"))
         )
         
-        # Map simplified IDs to actual ResetData model IDs
-        self.model_map = {
-            "llama-4-maverick": "meta-llama/Llama-4-Maverick-17B-128E-Instruct:shared",
-            "llama-3.2-vision": "meta/llama-3.2-11b-vision-instruct:shared",
-            "llama-3.1-8b": "meta/llama-3.1-8b-instruct:shared",
-        }
+        self._refresh_headers()
 
     def get_resetdata_models(self):
         """
@@ -48,66 +238,42 @@ class Pipeline:
         Using simple IDs to avoid URL encoding issues with special characters.
         """
         return [
-            {
-                "id": "llama-4-maverick",
-                "name": "Llama 4 Maverick 17B (1M context)"
-            },
-            {
-                "id": "llama-3.2-vision",
-                "name": "Llama 3.2 11B Vision Instruct"
-            },
-            {
-                "id": "llama-3.1-8b",
-                "name": "Llama 3.1 8B Instruct (Fast)"
-            },
+            {"id": model_id, "name": entry[0]}
+            for model_id, entry in _MODEL_REGISTRY.items()
         ]
 
     def get_actual_model_id(self, simplified_id: str) -> str:
         """
         Convert simplified model ID to actual ResetData model ID.
         """
-        return self.model_map.get(simplified_id, simplified_id)
+        entry = _MODEL_REGISTRY.get(simplified_id)
+        return entry[1] if entry is not None else simplified_id
 
-    def get_model_config(self, model_id: str) -> dict:
+    def get_model_config(self, model_id: str) -> Mapping:
         """
         Return model-specific configuration including max tokens.
+        The returned mapping is shared and read-only.
         """
-        configs = {
-            "llama-4-maverick": {
-                "max_tokens": self.valves.DEFAULT_MAX_TOKENS,
-                "context_window": 1000000,
-                "supports_vision": True,
-            },
-            "llama-3.2-vision": {
-                "max_tokens": min(self.valves.DEFAULT_MAX_TOKENS, 8192),
-                "context_window": 128000,
-                "supports_vision": True,
-            },
-            "llama-3.1-8b": {
-                "max_tokens": min(self.valves.DEFAULT_MAX_TOKENS, 8192),
-                "context_window": 128000,
-                "supports_vision": False,
-            },
-        }
-        return configs.get(model_id, {
-            "max_tokens": 8192,
-            "context_window": 128000,
-            "supports_vision": False,
-        })
+        return _resolve_model_config(model_id, self.valves.DEFAULT_MAX_TOKENS)
+
+    def _refresh_headers(self):
+        """Build the per-request headers; Content-Type is set once on the shared session"""
+        api_key = self.valves.RESETDATA_API_KEY
+        # Headers first, so a key match always implies headers for that key
+        self._headers = {"Authorization": f"Bearer {api_key}"}
+        self._headers_key = api_key
 
     async def on_startup(self):
-        print(f"on_startup:{__name__}")
-        print(f"Default max_tokens: {self.valves.DEFAULT_MAX_TOKENS}")
-        pass
+        logger.info("on_startup:%s", __name__)
+        logger.info("Default max_tokens: %s", self.valves.DEFAULT_MAX_TOKENS)
 
     async def on_shutdown(self):
-        print(f"on_shutdown:{__name__}")
-        pass
+        logger.info("on_shutdown:%s", __name__)
 
     async def on_valves_updated(self):
-        print(f"on_valves_updated:{__name__}")
-        print(f"Updated max_tokens: {self.valves.DEFAULT_MAX_TOKENS}")
-        pass
+        logger.info("on_valves_updated:%s", __name__)
+        self._refresh_headers()
+        logger.info("Updated max_tokens: %s", self.valves.DEFAULT_MAX_TOKENS)
 
     def pipelines(self) -> List[dict]:
         return self.get_resetdata_models()
@@ -116,10 +282,6 @@ class Pipeline:
         self, user_message: str, model_id: str, messages: List[dict], body: dict
     ) -> Union[str, Generator, Iterator]:
         try:
-            # Remove unnecessary keys that Open WebUI adds
-            for key in ['user', 'chat_id', 'title']:
-                body.pop(key, None)
-
             # Get model-specific configuration
             model_config = self.get_model_config(model_id)
             
@@ -131,126 +293,114 @@ class Pipeline:
             if not api_key:
                 return "Error: No API key configured. Please set RESETDATA_API_KEY in the pipeline valves or environment."
 
-            # Extract system message if present
-            system_message = None
-            filtered_messages = []
-            for message in messages:
-                if message.get("role") == "system":
-                    system_message = message.get("content", "")
-                else:
-                    filtered_messages.append(message)
-
-            # Build the messages array for the API
-            api_messages = []
-            if system_message:
-                api_messages.append({"role": "system", "content": system_message})
-            api_messages.extend(filtered_messages)
-
-            # Prepare headers
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {api_key}"
-            }
-
-            # Prepare the payload with ACTUAL model ID for ResetData API
-            # Use body's max_tokens if provided, otherwise use valve default
-            requested_max_tokens = body.get("max_tokens", model_config["max_tokens"])
-            
-            payload = {
-                "model": actual_model_id,
-                "messages": api_messages,
-                "max_tokens": requested_max_tokens,
-                "temperature": body.get("temperature", self.valves.DEFAULT_TEMPERATURE),
-                "top_p": body.get("top_p", 0.9),
-                "stream": body.get("stream", True),
-            }
-
-            # Add optional parameters if provided
-            if "stop" in body and body["stop"]:
-                payload["stop"] = body["stop"]
-            
-            if "frequency_penalty" in body:
-                payload["frequency_penalty"] = body["frequency_penalty"]
-            
-            if "presence_penalty" in body:
-                payload["presence_penalty"] = body["presence_penalty"]
+            # Valves can be replaced without on_valves_updated (e.g. persisted
+            # valves loaded at startup), so check the headers match the key
+            if api_key != self._headers_key:
+                self._refresh_headers()
+            headers = self._headers
+
+            # Open WebUI sends at most one system message, first in the list;
+            # in that case the history can be forwarded without copying
+            has_leading_system = bool(messages) and messages[0].get("role") == "system"
+            if (not has_leading_system or messages[0].get("content")) and not any(
+                message.get("role") == "system" for message in messages[1:]
+            ):
+                api_messages = messages
+            else:
+                # Otherwise keep the last system message and move it to the front
+                system_message = None
+                api_messages = []
+                for message in messages:
+                    if message.get("role") == "system":
+                        system_message = message.get("content", "")
+                    else:
+                        api_messages.append(message)
+                if system_message:
+                    api_messages.insert(0, {"role": "system", "content": system_message})
+
+            # Prepare the payload with ACTUAL model ID for ResetData API.
+            # Only whitelisted keys are copied from body, which is left untouched
+            payload = {"model": actual_model_id, "messages": api_messages}
+            payload.update({key: body[key] for key in _PAYLOAD_KEYS if key in body})
+            payload.setdefault("max_tokens", model_config["max_tokens"])
+            payload.setdefault("temperature", self.valves.DEFAULT_TEMPERATURE)
+            payload.setdefault("top_p", 0.9)
+            payload.setdefault("stream", True)
+            if not payload.get("stop"):
+                payload.pop("stop", None)
 
             url = f"{self.valves.RESETDATA_BASE_URL}/chat/completions"
 
-            if body.get("stream", True):
-                return self.stream_response(url, headers, payload)
+            # Serialize once up front so requests sends the bytes as-is
+            body_bytes = _json_dumps(payload)
+
+            if payload["stream"]:
+                return self.stream_response(url, headers, body_bytes)
             else:
-                return self.get_completion(url, headers, payload)
+                return self.get_completion(url, headers, body_bytes)
 
         except Exception as e:
             return f"Error: {e}"
 
-    def stream_response(self, url: str, headers: dict, payload: dict) -> Generator:
+    def stream_response(self, url: str, headers: dict, body_bytes: bytes) -> Generator:
         """Handle streaming responses from the API."""
+        import requests
+
         try:
-            response = requests.post(
-                url,
-                headers=headers,
-                json=payload,
-                stream=True,
-                timeout=600
-            )
+            response = _get_http().post(url, headers, body_bytes, stream=True)
 
-            if response.status_code == 200:
-                for line in response.iter_lines(decode_unicode=True):
-                    if line:
-                        if line.startswith("data: "):
-                            data_str = line[6:]
-                            if data_str.strip() == "[DONE]":
+            # Always release the response, including when the caller abandons
+            # the generator early or the request fails
+            try:
+                if response.status_code == 200:
+                    # Work on raw bytes; the JSON parser decodes UTF-8 itself
+                    events = _iter_events(response)
+                    for data_str in events:
+                        # Completion chunks are JSON objects; anything else is
+                        # either the end marker or skipped without parsing
+                        if not data_str.startswith(b"{"):
+                            if data_str.strip() == b"[DONE]":
                                 break
-                            try:
-                                data = json.loads(data_str)
-                                if "choices" in data and len(data["choices"]) > 0:
-                                    delta = data["choices"][0].get("delta", {})
-                                    content = delta.get("content", "")
-                                    if content:
-                                        yield content
-                            except json.JSONDecodeError:
-                                continue
-            else:
-                error_detail = response.text
-                try:
-                    error_json = response.json()
-                    if "error" in error_json:
-                        error_detail = error_json["error"].get("message", response.text)
-                except:
-                    pass
-                raise Exception(f"Error {response.status_code}: {error_detail}")
+                            continue
+                        try:
+                            data = _json_loads(data_str)
+                        except ValueError:
+                            logger.warning("Skipping unparseable stream chunk: %.200r", data_str)
+                            continue
+                        if "choices" in data and len(data["choices"]) > 0:
+                            delta = data["choices"][0].get("delta", {})
+                            content = delta.get("content", "")
+                            if content:
+                                yield content
+
+                    # Read on to the end of the body so urllib3 sees the chunked
+                    # terminator and can return the connection to the pool
+                    for _ in events:
+                        pass
+                else:
+                    raise Exception(f"Error {response.status_code}: {_extract_error(response)}")
+            finally:
+                response.close()
 
         except requests.exceptions.Timeout:
             raise Exception("Request timed out. The model may be processing a large request.")
         except requests.exceptions.RequestException as e:
             raise Exception(f"Request failed: {e}")
 
-    def get_completion(self, url: str, headers: dict, payload: dict) -> str:
+    def get_completion(self, url: str, headers: dict, body_bytes: bytes) -> str:
         """Handle non-streaming responses from the API."""
+        import requests
+
         try:
-            response = requests.post(
-                url,
-                headers=headers,
-                json=payload,
-                timeout=600
-            )
+            response = _get_http().post(url, headers, body_bytes)
 
             if response.status_code == 200:
-                res = response.json()
+                res = _json_loads(response.content)
                 if "choices" in res and len(res["choices"]) > 0:
                     return res["choices"][0].get("message", {}).get("content", "")
                 return ""
             else:
-                error_detail = response.text
-                try:
-                    error_json = response.json()
-                    if "error" in error_json:
-                        error_detail = error_json["error"].get("message", response.text)
-                except:
-                    pass
-                raise Exception(f"Error {response.status_code}: {error_detail}")
+                raise Exception(f"Error {response.status_code}: {_extract_error(response)}")
 
         except requests.exceptions.Timeout:
             raise Exception("Request timed out. The model may be processing a large request.")
@@ -1,4 +1,4 @@
-from typing import List, Union, Generator, Iterator
+from typing import Callable, List, Union, Generator, Iterator
 from pydantic import BaseModel
 
 class Pipeline:
@@ -18,6 +18,11 @@ class Pipeline:
                 "PREFIX_TEXT": "Processed: "
             }
         )
+        
+        # Transforms applied by process_text, resolved from the valves up front
+        self._ops: List[Callable[[str], str]] = []
+        self._ops_key = None
+        self._rebuild_ops(self._valves_key())
 
     async def on_startup(self):
         # This function is called when the server is started
@@ -29,15 +34,41 @@ class Pipeline:
         print(f"Shutting down {self.name}")
         pass
 
+    async def on_valves_updated(self):
+        # This function is called when the valves are updated
+        self._rebuild_ops(self._valves_key())
+
+    def _valves_key(self):
+        """The valve values the transforms depend on"""
+        valves = self.valves
+        return (valves.UPPERCASE_ENABLED, valves.ADD_PREFIX, valves.PREFIX_TEXT)
+
+    def _rebuild_ops(self, key):
+        """Resolve the valve settings into the list of transforms to apply"""
+        uppercase_enabled, add_prefix, prefix = key
+        ops = []
+        
+        if uppercase_enabled:
+            ops.append(str.upper)
+            
+        if add_prefix:
+            ops.append(lambda text: prefix + text)
+            
+        self._ops = ops
+        self._ops_key = key
+
     def process_text(self, text: str) -> str:
         """Process the input text based on valve settings"""
+        # Valves may be replaced or edited in place without on_valves_updated
+        # being called, so compare their values rather than the object
+        key = self._valves_key()
+        if key != self._ops_key:
+            self._rebuild_ops(key)
+            
         result = text
         
-        if self.valves.UPPERCASE_ENABLED:
-            result = result.upper()
-            
-        if self.valves.ADD_PREFIX:
-            result = f"{self.valves.PREFIX_TEXT}{result}"
+        for op in self._ops:
+            result = op(result)
             
         return result
 